@@ -1,30 +1,31 @@
 # streamlit_app.py
 
+import hashlib
 import io
-from zipfile import ZipFile, ZIP_DEFLATED
-import zipfile
+import multiprocessing as mp
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from zipfile import ZipFile, ZIP_STORED
 
 import streamlit as st
-from pypdf import PdfReader, PdfWriter
-from reportlab.pdfgen import canvas
-import pypdfium2 as pdfium
-from PIL import Image
+
+from watermark_core import RASTER_SCALE, init_worker, process_image, process_pdf
 
 # ============================
 # Global settings
 # ============================
 MAX_FILES = 50
-
-# Watermark settings
-WM_TEXT = "DRAFT"
-WM_OPACITY = 0.12          # simulated via very light gray
-WM_COLOR = (0.7, 0.7, 0.7) # light gray (RGB 0–1)
-WM_ROTATE = 45             # bottom-left → top-right
-WM_FONT = "Helvetica"
-WM_SCALE = 0.18            # proportional to page diagonal
-
-# Rasterization settings for PDF → image
-RASTER_SCALE = 2.0         # 2.0–3.0 = sharper, bigger files
+WORKER_CAP = 4  # each worker holds pdfium, Pillow and a rendered page
+try:
+    # CPUs this process may run on; os.cpu_count() reports every host
+    # core, even inside a container pinned to a few of them
+    _CPUS = len(os.sched_getaffinity(0))
+except AttributeError:  # no sched_getaffinity on macOS/Windows
+    _CPUS = os.cpu_count() or 1
+MAX_WORKERS = min(_CPUS, WORKER_CAP)  # conversion processes (shared pool)
+WARM_WORKERS = min(2, MAX_WORKERS)  # started on page load; rest on demand
+CACHE_MAX_BYTES = 50_000_000  # larger uploads are never cached
 
 st.set_page_config(page_title="DRAFT Converter", layout="wide")
 
@@ -33,95 +34,95 @@ st.set_page_config(page_title="DRAFT Converter", layout="wide")
 # ----------------------------
 for key, default in [
     ("pdf_files", []),            # [{name, data}]
-    ("pdf_image_results", []),    # [{base, images:[(fname, bytes)]}]
+    ("pdf_ids", []),              # file_ids behind pdf_files
+    ("pdf_cache", {}),            # {(name, digest, scale): [entry index]}
+    ("pdf_zip", b""),             # ZIP of the last Section 1 run
     ("img_files", []),            # [(name, bytes)]
-    ("img_pdf_results", []),      # [(pdf_name, bytes)]
+    ("img_ids", []),              # file_ids behind img_files
+    ("img_zip", b""),             # ZIP of the last Section 2 run
 ]:
     if key not in st.session_state:
         st.session_state[key] = default
 
 
 # ============================
-# Helpers – watermark & PDF↔image
+# Helpers
 # ============================
-def _create_watermark_page(width: float, height: float):
-    """Create one-page PDF with centered diagonal DRAFT."""
-    packet = io.BytesIO()
-    c = canvas.Canvas(packet, pagesize=(width, height))
-
-    diag = (width ** 2 + height ** 2) ** 0.5
-    fontsize = max(24, int(diag * WM_SCALE))
-
-    c.saveState()
-    c.translate(width / 2.0, height / 2.0)
-    c.rotate(WM_ROTATE)
-
-    r, g, b = WM_COLOR
-    c.setFillColorRGB(r, g, b)
-    try:
-        c.setFillAlpha(WM_OPACITY)
-    except Exception:
-        pass
-
-    c.setFont(WM_FONT, fontsize)
-    c.drawCentredString(0, -fontsize / 4.0, WM_TEXT)
-    c.restoreState()
-
-    c.showPage()
-    c.save()
-    packet.seek(0)
-
-    wm_reader = PdfReader(packet)
-    return wm_reader.pages[0]
-
-
-def add_draft_watermark(pdf_bytes: bytes) -> bytes:
-    """Apply DRAFT watermark to every page of a PDF."""
-    reader = PdfReader(io.BytesIO(pdf_bytes))
-    writer = PdfWriter()
-
-    for page in reader.pages:
-        width = float(page.mediabox.width)
-        height = float(page.mediabox.height)
-        wm_page = _create_watermark_page(width, height)
-        page.merge_page(wm_page)
-        writer.add_page(page)
-
-    out = io.BytesIO()
-    writer.write(out)
-    out.seek(0)
-    return out.getvalue()
-
-
-def pdf_to_images(watermarked_pdf: bytes, base_name: str):
-    """Convert watermarked PDF → list[(filename, jpg_bytes)]."""
-    pdf = pdfium.PdfDocument(watermarked_pdf)
-    images = []
-
-    for idx in range(len(pdf)):
-        page = pdf[idx]
-        bitmap = page.render(scale=RASTER_SCALE)
-        pil_img = bitmap.to_pil()
-        buf = io.BytesIO()
-        pil_img.save(buf, format="JPEG", quality=90)
-        buf.seek(0)
-        img_name = f"{base_name}_page_{idx+1:03d}.jpg"
-        images.append((img_name, buf.getvalue()))
-
-    pdf.close()
-    return images
-
-
-def image_to_pdf(img_bytes: bytes, base_name: str):
-    """Convert one image → one-page PDF."""
-    img = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    out = io.BytesIO()
-    img.save(out, format="PDF")
-    out.seek(0)
-    pdf_name = f"{base_name}.pdf"
-    return pdf_name, out.getvalue()
+@st.cache_resource
+def _pool():
+    """Process pool shared by every session and rerun.
+
+    Starting workers (and importing pdfium/Pillow/reportlab in each) is
+    paid once per server instead of once per click. "spawn" because
+    forking the multi-threaded Streamlit server is not safe.
+    """
+    pool = ProcessPoolExecutor(
+        max_workers=MAX_WORKERS,
+        mp_context=mp.get_context("spawn"),
+        initializer=init_worker,
+    )
+    # workers only start on submit; queue a couple of no-ops so the first
+    # click finds some of them warm, without spawning the whole pool for
+    # a page view that may never convert anything
+    for _ in range(WARM_WORKERS):
+        pool.submit(init_worker)
+    return pool
+
+
+def _drop_pool(pool):
+    """Forget a pool whose worker died; the next run starts a fresh one.
+
+    A dead worker (OOM kill, pdfium crash) breaks the executor for good,
+    and since the pool is shared that would fail every later click of
+    every user. Only drop it if no other session has replaced it already.
+    """
+    if _pool() is pool:
+        _pool.clear()
+    st.error(
+        "A conversion process crashed, possibly out of memory. "
+        "Please try again, with fewer or smaller files if it persists."
+    )
+
+
+def _cache_key(name: str, data: bytes, *options):
+    """(name, content digest, *options) for a cacheable upload, else None."""
+    if len(data) > CACHE_MAX_BYTES:
+        return None
+    return (name, hashlib.blake2b(data, digest_size=16).hexdigest(), *options)
+
+
+def _new_zip(buf):
+    """ZIP writer for already-compressed outputs (JPEG pages, image PDFs)."""
+    # DEFLATE over JPEG data only burns CPU
+    return ZipFile(buf, "w", compression=ZIP_STORED, allowZip64=True)
 
 
+def _zip_pdf_images(zf, pdf_result):
+    """Write one PDF's page images into the archive → their entry indices."""
+    folder = pdf_result["base"]
+    entries = []
+    for fname, data in pdf_result["images"]:
+        # keep each PDF’s pages in its own subfolder
+        entries.append(len(zf.filelist))
+        zf.writestr(f"{folder}/{fname}", data)
+    return entries
+
+
+# start (or reuse) the workers on the first page load, not the first click
+_pool()
+
+# ----------------------------
+# Sidebar – output settings
+# ----------------------------
+raster_scale = st.sidebar.slider(
+    "Raster scale",
+    min_value=1.0,
+    max_value=3.0,
+    value=RASTER_SCALE,
+    step=0.25,
+    help="Higher is sharper but slower, with bigger images and ZIPs.",
+)
+
 # ======================================================
 # SECTION 1 – PDF Upload & Conversion
 # ======================================================
@@ -141,10 +142,14 @@ with col1:
     if pdf_upload and len(pdf_upload) > MAX_FILES:
         st.error(f"You can upload up to {MAX_FILES} attachments at a time.")
         pdf_upload = []
-    if pdf_upload:
+    # only re-read when the selection changed, not on every rerun
+    if pdf_upload and [f.file_id for f in pdf_upload] != st.session_state.pdf_ids:
+        # getvalue() hands back UploadedFile's own bytes without a copy
+        # and, unlike read(), does not depend on the stream position
         st.session_state.pdf_files = [
-            {"name": f.name, "data": f.read()} for f in pdf_upload
+            {"name": f.name, "data": f.getvalue()} for f in pdf_upload
         ]
+        st.session_state.pdf_ids = [f.file_id for f in pdf_upload]
     st.caption("You can upload up to 50 attachments at a time.")
 
 # --------- Convert button (middle) ----------
@@ -167,36 +172,78 @@ if convert_pdf_to_img:
     if not pdfs:
         st.warning("Please upload at least one PDF first.")
     else:
-        results = []
-        with st.spinner(f"Processing {len(pdfs)} PDF(s)…"):
-            for item in pdfs:
-                name = item["name"]
-                data = item["data"]
-                base = name.rsplit(".pdf", 1)[0]
-
-                watermarked = add_draft_watermark(data)
-                images = pdf_to_images(watermarked, base)
-
-                results.append({"base": base, "images": images})
-
-        st.session_state.pdf_image_results = results
-        st.success("All DRAFT PDFs converted to images.")
-
-# --------- Build ZIP for Section 1 ----------
-if st.session_state.pdf_image_results:
-    memzip = io.BytesIO()
-    with ZipFile(memzip, "w", compression=ZIP_DEFLATED) as zf:
-        for pdf_result in st.session_state.pdf_image_results:
-            folder = pdf_result["base"]
-            for fname, data in pdf_result["images"]:
-                # keep each PDF’s pages in its own subfolder
-                zf.writestr(f"{folder}/{fname}", data)
-    memzip.seek(0)
-
+        # files converted by the previous click are copied over from its
+        # ZIP; the archive is the only place their pages are kept. Entries
+        # are tracked by index, not name: same-named uploads with different
+        # content write the same arcnames, and a lookup by name would hand
+        # both of them the last file's pages
+        keys = [
+            _cache_key(item["name"], item["data"], raster_scale) for item in pdfs
+        ]
+        cache = st.session_state.pdf_cache
+        todo = [idx for idx, key in enumerate(keys) if key not in cache]
+        new_cache = {}
+        broken = None  # the pool, if a worker died during this run
+
+        progress = st.progress(1.0 - len(todo) / len(pdfs))
+        memzip = io.BytesIO()
+        with st.spinner(f"Processing {len(pdfs)} PDF(s)…"), _new_zip(memzip) as zf:
+            if len(todo) < len(pdfs):
+                with ZipFile(io.BytesIO(st.session_state.pdf_zip)) as prev:
+                    for key in keys:
+                        if key in cache:
+                            entries = []
+                            for i in cache[key]:
+                                info = prev.filelist[i]
+                                entries.append(len(zf.filelist))
+                                zf.writestr(info.filename, prev.read(info))
+                            new_cache[key] = entries
+            if todo:
+                pool = _pool()
+                futures = {}
+                try:
+                    # one task per PDF: the work is CPU-bound, holds the GIL
+                    for idx in todo:
+                        fut = pool.submit(
+                            process_pdf,
+                            pdfs[idx]["name"],
+                            pdfs[idx]["data"],
+                            raster_scale,
+                        )
+                        futures[fut] = idx
+                    done = len(pdfs) - len(todo)
+                    # archive each PDF as soon as its worker returns and
+                    # drop the page bytes right after
+                    for fut in as_completed(futures):
+                        key = keys[futures.pop(fut)]
+                        entries = _zip_pdf_images(zf, fut.result())
+                        if key:
+                            new_cache[key] = entries
+                        done += 1
+                        progress.progress(done / len(pdfs))
+                except BrokenProcessPool:
+                    broken = pool
+                finally:
+                    # if a file failed, the rest of this batch must not
+                    # keep the shared pool busy for other users
+                    for fut in futures:
+                        fut.cancel()
+        progress.empty()
+
+        if broken is not None:
+            _drop_pool(broken)
+        else:
+            st.session_state.pdf_zip = memzip.getvalue()
+            # only the latest batch is kept, which bounds the cache's size
+            st.session_state.pdf_cache = new_cache
+            st.success("All DRAFT PDFs converted to images.")
+
+# --------- Download ZIP for Section 1 ----------
+if st.session_state.pdf_zip:
     with col3:
         download_pdf_images_placeholder.download_button(
             "Download",
-            data=memzip,
+            data=st.session_state.pdf_zip,
             file_name="draft_pdfs_as_images.zip",
             mime="application/zip",
             use_container_width=True,
@@ -225,14 +272,14 @@ with col4:
     if img_upload and len(img_upload) > MAX_FILES:
         st.error(f"You can upload up to {MAX_FILES} attachments at once.")
         img_upload = []
-    if img_upload:
+    # only re-read (and re-extract ZIPs) when the selection changed
+    if img_upload and [f.file_id for f in img_upload] != st.session_state.img_ids:
         for f in img_upload:
             name = f.name
-            data = f.read()
+            data = f.getvalue()
 
             if name.lower().endswith(".zip"):
-                zbuf = io.BytesIO(data)
-                with zipfile.ZipFile(zbuf, "r") as zf:
+                with ZipFile(io.BytesIO(data), "r") as zf:
                     for info in zf.infolist():
                         if info.is_dir():
                             continue
@@ -247,6 +294,7 @@ with col4:
                 img_list.append((name, data))
 
         st.session_state.img_files = img_list
+        st.session_state.img_ids = [f.file_id for f in img_upload]
 
     st.caption("You can upload up to 50 attachments at once (ZIP with images is allowed).")
 
@@ -270,28 +318,39 @@ if convert_img_to_pdf:
     if not imgs:
         st.warning("Please upload at least one image or ZIP first.")
     else:
-        results = []
-        with st.spinner(f"Converting {len(imgs)} image(s) to PDF…"):
-            for name, data in imgs:
-                base = name.rsplit(".", 1)[0] if "." in name else name
-                pdf_name, pdf_bytes = image_to_pdf(data, base)
-                results.append((pdf_name, pdf_bytes))
-
-        st.session_state.img_pdf_results = results
-        st.success("All images converted to PDFs.")
-
-# --------- Build ZIP for Section 2 ----------
-if st.session_state.img_pdf_results:
-    memzip2 = io.BytesIO()
-    with ZipFile(memzip2, "w", compression=ZIP_DEFLATED) as zf:
-        for fname, data in st.session_state.img_pdf_results:
-            zf.writestr(fname, data)
-    memzip2.seek(0)
-
+        progress = st.progress(0.0)
+        memzip2 = io.BytesIO()
+        pool = _pool()
+        broken = None
+        with st.spinner(f"Converting {len(imgs)} image(s) to PDF…"), _new_zip(memzip2) as zf:
+            try:
+                # decode/encode is CPU-bound, so images fan out like PDFs
+                # do; map() yields in upload order, keeping the archive
+                # ordered, and cancels what is left if a result raises
+                converted = pool.map(
+                    process_image,
+                    [name for name, _ in imgs],
+                    [data for _, data in imgs],
+                )
+                for done, (pdf_name, pdf_bytes) in enumerate(converted, start=1):
+                    zf.writestr(pdf_name, pdf_bytes)
+                    progress.progress(done / len(imgs))
+            except BrokenProcessPool:
+                broken = pool
+        progress.empty()
+
+        if broken is not None:
+            _drop_pool(broken)
+        else:
+            st.session_state.img_zip = memzip2.getvalue()
+            st.success("All images converted to PDFs.")
+
+# --------- Download ZIP for Section 2 ----------
+if st.session_state.img_zip:
     with col6:
         download_img_pdfs_placeholder.download_button(
             "Download",
-            data=memzip2,
+            data=st.session_state.img_zip,
             file_name="images_as_pdfs.zip",
             mime="application/zip",
             use_container_width=True,
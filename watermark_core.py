@@ -0,0 +1,247 @@
+# watermark_core.py
+#
+# UI-free helpers used by streamlit_app.py. Kept in their own module so
+# they can be pickled into worker processes (the Streamlit script itself
+# is re-executed on every rerun and is not importable).
+
+import io
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from reportlab.lib.pagesizes import A4, LETTER
+from reportlab.pdfgen import canvas
+import pypdfium2 as pdfium
+from PIL import Image
+
+# ============================
+# Watermark settings
+# ============================
+WM_TEXT = "DRAFT"
+WM_OPACITY = 0.12          # simulated via very light gray
+WM_COLOR = (0.7, 0.7, 0.7) # light gray (RGB 0–1)
+WM_ROTATE = 45             # bottom-left → top-right
+WM_FONT = "Helvetica"
+WM_SCALE = 0.18            # proportional to page diagonal
+
+# Rasterization settings for PDF → image
+RASTER_SCALE = 1.5         # default; 2.0–3.0 = sharper, bigger files
+MAX_PAGE_PIXELS = 25_000_000  # per-page cap; huge pages render smaller
+ENCODE_THREADS = 2         # JPEG encoders overlapping pdfium rendering
+JPEG_QUALITY = 85          # with 4:2:0 chroma; plenty for a DRAFT copy
+
+
+# ============================
+# Helpers – watermark & PDF↔image
+# ============================
+def _create_watermark_pdf(width: float, height: float) -> bytes:
+    """Create one-page PDF with centered diagonal DRAFT."""
+    packet = io.BytesIO()
+    # tiny content stream: zlib would cost more than it saves
+    c = canvas.Canvas(packet, pagesize=(width, height), pageCompression=0)
+
+    diag = (width ** 2 + height ** 2) ** 0.5
+    fontsize = max(24, int(diag * WM_SCALE))
+
+    c.saveState()
+    c.translate(width / 2.0, height / 2.0)
+    c.rotate(WM_ROTATE)
+
+    r, g, b = WM_COLOR
+    c.setFillColorRGB(r, g, b)
+    try:
+        c.setFillAlpha(WM_OPACITY)
+    except Exception:
+        pass
+
+    c.setFont(WM_FONT, fontsize)
+    c.drawCentredString(0, -fontsize / 4.0, WM_TEXT)
+    c.restoreState()
+
+    c.showPage()
+    c.save()
+    return packet.getvalue()
+
+
+def _page_key(width: float, height: float):
+    """Round a page size to 0.5 pt so float noise shares one overlay."""
+    return round(width * 2) / 2, round(height * 2) / 2
+
+
+# Overlays for the page sizes nearly every upload uses, built once at
+# import so the common case never touches reportlab. Both orientations,
+# and A4 also as the integer MediaBox [0 0 595 842] most producers
+# write (reportlab's A4 is 595.28 pt wide, which keys to 595.5).
+_COMMON_SIZES = (LETTER, A4, (595, 842))
+_PRECOMPUTED_WM = {
+    key: _create_watermark_pdf(*key)
+    for w, h in _COMMON_SIZES
+    for key in (_page_key(w, h), _page_key(h, w))
+}
+
+
+@lru_cache(maxsize=16)
+def _watermark_doc(width: float, height: float):
+    """Parsed watermark PDF per page size, shared across files.
+
+    page_as_xobject only reads the source document, so one parsed
+    overlay can be imported into any number of target documents.
+    """
+    wm_bytes = _PRECOMPUTED_WM.get((width, height))
+    if wm_bytes is None:
+        wm_bytes = _create_watermark_pdf(width, height)
+    return pdfium.PdfDocument(wm_bytes)
+
+
+def _encode_jpeg(pil_img) -> bytes:
+    """Encode one rendered page as JPEG."""
+    buf = io.BytesIO()
+    pil_img.save(
+        buf,
+        format="JPEG",
+        quality=JPEG_QUALITY,
+        optimize=False,
+        progressive=False,
+        subsampling=2,  # 4:2:0
+    )
+    return buf.getvalue()
+
+
+def _page_scale(width: float, height: float, scale: float) -> float:
+    """Render scale for one page, lowered to fit MAX_PAGE_PIXELS."""
+    budget = (MAX_PAGE_PIXELS / max(width * height, 1.0)) ** 0.5
+    return min(scale, budget)
+
+
+def stamp_and_rasterize(
+    pdf_bytes: bytes, base_name: str, scale: float = RASTER_SCALE
+):
+    """Stamp DRAFT on every page and render → list[(filename, jpg_bytes)].
+
+    The overlay is drawn into the pdfium document as a form XObject and
+    the page is rendered right away, so no watermarked PDF is serialized
+    and parsed again in between.
+
+    pdfium is not thread-safe, so pages are rendered one at a time on
+    this thread; JPEG encoding (which releases the GIL) runs on a small
+    thread pool and overlaps with rendering the next page.
+    """
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    images = []
+    xobjects = {}      # page size → overlay imported into this document
+    pending = deque()  # (idx, bitmap, future) – the PIL image shares the
+                       # bitmap's buffer, so keep it alive until encoded
+
+    def collect():
+        idx, _bitmap, future = pending.popleft()
+        img_name = f"{base_name}_page_{idx+1:03d}.jpg"
+        images.append((img_name, future.result()))
+
+    # the pool workers are long-lived, so a page that fails to render
+    # must not leave the document (and its buffers) open
+    try:
+        with ThreadPoolExecutor(max_workers=ENCODE_THREADS) as encoder:
+            for idx in range(len(pdf)):
+                page = pdf[idx]
+                left, bottom, right, top = page.get_mediabox()
+                key = _page_key(right - left, top - bottom)
+                if key not in xobjects:
+                    # import once per size; every page then references the
+                    # same form XObject instead of its own copy
+                    xobjects[key] = _watermark_doc(*key).page_as_xobject(0, pdf)
+                wm_obj = xobjects[key].as_pageobject()
+                wm_obj.transform(pdfium.PdfMatrix().translate(left, bottom))
+                page.insert_obj(wm_obj)
+                page.gen_content()
+
+                # 4-byte RGBX is a mode Pillow can map without copying
+                # (3-byte RGB is not), so to_pil() wraps pdfium's buffer
+                # as-is; the JPEG encoder drops the padding byte itself
+                bitmap = page.render(
+                    scale=_page_scale(right - left, top - bottom, scale),
+                    prefer_bgrx=True,
+                    rev_byte_order=True,
+                )
+                page.close()
+                future = encoder.submit(_encode_jpeg, bitmap.to_pil())
+                pending.append((idx, bitmap, future))
+                # bound the number of rendered-but-unencoded pages in memory
+                if len(pending) > ENCODE_THREADS:
+                    collect()
+
+            while pending:
+                collect()
+    finally:
+        pdf.close()
+    return images
+
+
+def _jpeg_to_pdf(jpg_bytes: bytes, width: int, height: int, out) -> None:
+    """Write a one-page PDF that embeds the JPEG data verbatim.
+
+    pdfium copies the DCT stream into the page as is (DCTDecode): no
+    pixel decode and no lossy re-encode, and the PDF is about the size
+    of the JPEG.
+    """
+    pdf = pdfium.PdfDocument.new()
+    try:
+        page = pdf.new_page(width, height)
+        image = pdfium.PdfImage.new(pdf)
+        # inline: read the data now rather than lazily at save time
+        image.load_jpeg(io.BytesIO(jpg_bytes), inline=True)
+        image.set_matrix(pdfium.PdfMatrix().scale(width, height))
+        page.insert_obj(image)
+        page.gen_content()
+        page.close()
+        pdf.save(out)
+    finally:
+        pdf.close()
+
+
+def image_to_pdf(img_bytes: bytes, base_name: str):
+    """Convert one image → one-page PDF."""
+    out = io.BytesIO()
+
+    # Image.open only parses the header; pixels are decoded on the
+    # Pillow paths below, and closing the image frees them right away
+    # instead of whenever the worker's GC gets to it
+    with Image.open(io.BytesIO(img_bytes)) as img:
+        if img.format == "JPEG" and img.mode in ("RGB", "L"):
+            _jpeg_to_pdf(img_bytes, *img.size, out)
+        elif img.mode in ("RGB", "L"):
+            # Pillow writes RGB and L directly, grayscale single-channel
+            img.save(out, format="PDF")
+        else:
+            # palette, alpha, ... need converting first
+            with img.convert("RGB") as rgb:
+                rgb.save(out, format="PDF")
+
+    pdf_name = f"{base_name}.pdf"
+    return pdf_name, out.getvalue()
+
+
+# ============================
+# Per-file workers (run in a process pool)
+# ============================
+def init_worker():
+    """Process-pool initializer: parse the common overlays up front.
+
+    pdfium itself is initialized once per process on import; this also
+    loads the Letter/A4 overlays (and their Helvetica resources) so the
+    first file a worker gets does not pay for it.
+    """
+    for key in _PRECOMPUTED_WM:
+        _watermark_doc(*key)
+
+
+def process_pdf(name: str, data: bytes, scale: float = RASTER_SCALE):
+    """Watermark one PDF and rasterize it → {base, images}."""
+    base = name.rsplit(".pdf", 1)[0]
+    images = stamp_and_rasterize(data, base, scale)
+    return {"base": base, "images": images}
+
+
+def process_image(name: str, data: bytes):
+    """Convert one uploaded image → (pdf_name, pdf_bytes)."""
+    base = name.rsplit(".", 1)[0] if "." in name else name
+    return image_to_pdf(data, base)